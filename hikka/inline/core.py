@@ -46,6 +46,8 @@ class InlineManager(
 ):
     _units = {}
     _custom_map = {}
+    _sec_map_cache = {}
+    _markup_cache = {}
 
     fsm = {}
 
@@ -75,6 +77,9 @@ class InlineManager(
                 if unit.get("ttl", time.time() + self._markup_ttl) < time.time():
                     del self._units[unit_id]
 
+            for unit_id in self._markup_cache.keys() - self._units.keys():
+                del self._markup_cache[unit_id]
+
             await asyncio.sleep(5)
 
     async def _register_manager(
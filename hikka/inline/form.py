@@ -85,7 +85,8 @@ class Form(InlineUnit):
                 be bigger, than default one (1 day) and must be either `int` or `False`
             on_unload
                 Callback, called when form is unloaded and/or closed. You can clean up trash
-                or perform another needed action
+                or perform another needed action. Can be a coroutine function, so blocking
+                cleanup can be awaited instead of stalling the event loop
             manual_security
                 By default, Hikka will try to inherit inline buttons security from the caller (command)
                 If you want to avoid this, pass `manual_security=True`
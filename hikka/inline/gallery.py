@@ -77,7 +77,8 @@ class Gallery(InlineUnit):
                 be bigger, than default one (1 day) and must be either `int` or `False`
             on_unload
                 Callback, called when gallery is unloaded and/or closed. You can clean up trash
-                or perform another needed action
+                or perform another needed action. Can be a coroutine function, so blocking
+                cleanup can be awaited instead of stalling the event loop
             preload
                 Either to preload gallery photos beforehand or no. If yes - specify threshold to
                 be loaded. Toggle this attribute, if your callback is too slow to load photos
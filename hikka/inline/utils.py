@@ -1,13 +1,15 @@
+# Keeps PEP 604 annotations unevaluated, as Python 3.8 is still supported
+from __future__ import annotations
+
 import asyncio
-import inspect
 import logging
 import contextlib
+import functools
 import io
-import os
-from copy import deepcopy
+import secrets
+import sys
 from types import FunctionType
-from typing import List, Optional, Union
-from urllib.parse import urlparse
+from typing import Any
 
 from aiogram.types import (
     CallbackQuery,
@@ -34,18 +36,53 @@ from .types import InlineUnit
 
 logger = logging.getLogger(__name__)
 
+_UNSET = object()
+
+# `utils.check_url` is pure, so repeated renders of the same urls hit the cache
+_check_url_cached = functools.lru_cache(maxsize=4096)(utils.check_url)
+
+
+def _fast_button(text: str, **kwargs) -> InlineKeyboardButton:
+    """Create button from trusted values, skipping aiogram per-field setup"""
+    button = InlineKeyboardButton.__new__(InlineKeyboardButton)
+    button._conf = {}
+    button.values.update(text=text, **kwargs)
+    return button
+
+
+# Make sure the shortcut serializes exactly like the regular constructor
+try:
+    _make_button = (
+        _fast_button
+        if _fast_button("-", url="-").to_python()
+        == InlineKeyboardButton("-", url="-").to_python()
+        else InlineKeyboardButton
+    )
+except Exception:
+    _make_button = InlineKeyboardButton
+
+
+_ANIMATED_EXTS = frozenset((".gif", ".mp4"))
+
+# Media types, matching `file`, `photo`, `audio`, `video`, `gif` params of `_edit_unit`
+_MEDIA_TYPES = (
+    InputMediaDocument,
+    InputMediaPhoto,
+    InputMediaAudio,
+    InputMediaVideo,
+    InputMediaAnimation,
+)
+
 
 class Utils(InlineUnit):
     def _generate_markup(
         self,
-        markup_obj: Union[str, list],
-    ) -> Union[None, InlineKeyboardMarkup]:
+        markup_obj: str | list,
+    ) -> InlineKeyboardMarkup | None:
         """Generate markup for form or list of `dict`s"""
         if not markup_obj:
             return None
 
-        markup = InlineKeyboardMarkup()
-
         map_ = (
             self._units[markup_obj]["buttons"]
             if isinstance(markup_obj, str)
@@ -54,113 +91,27 @@ class Utils(InlineUnit):
 
         map_ = self._normalize_markup(map_)
 
-        setup_callbacks = False
+        rows = [None] * len(map_)
 
-        for row in map_:
+        for i, row in enumerate(map_):
+            line = []
             for button in row:
                 if not isinstance(button, dict):
-                    logger.error(f"Button {button} is not a `dict`, but `{type(button)}` in {map_}")  # fmt: skip
+                    logger.error("Button %s is not a `dict`, but `%s` in %s", button, type(button), map_)  # fmt: skip
                     return None
 
-                if "callback" in button and "_callback_data" not in button:
-                    button["_callback_data"] = utils.rand(30)
-                    setup_callbacks = True
-
-                if "input" in button and "_switch_query" not in button:
-                    button["_switch_query"] = utils.rand(10)
+                kind = _get_button_kind(button)
+                if kind is None:
+                    logger.warning(
+                        "Button have not been added to "
+                        "form, because it is not structured "
+                        "properly. %s",
+                        button,
+                    )
+                    continue
 
-        for row in map_:
-            line = []
-            for button in row:
                 try:
-                    if "url" in button:
-                        if not utils.check_url(button["url"]):
-                            logger.warning(
-                                "Button have not been added to form, "
-                                "because its url is invalid"
-                            )
-                            continue
-
-                        line += [
-                            InlineKeyboardButton(
-                                button["text"],
-                                url=button["url"],
-                            )
-                        ]
-                    elif "callback" in button:
-                        line += [
-                            InlineKeyboardButton(
-                                button["text"],
-                                callback_data=button["_callback_data"],
-                            )
-                        ]
-                        if setup_callbacks:
-                            self._custom_map[button["_callback_data"]] = {
-                                "handler": button["callback"],
-                                **(
-                                    {"always_allow": button["always_allow"]}
-                                    if button.get("always_allow", False)
-                                    else {}
-                                ),
-                                **(
-                                    {"args": button["args"]}
-                                    if button.get("args", False)
-                                    else {}
-                                ),
-                                **(
-                                    {"kwargs": button["kwargs"]}
-                                    if button.get("kwargs", False)
-                                    else {}
-                                ),
-                                **(
-                                    {"force_me": True}
-                                    if button.get("force_me", False)
-                                    else {}
-                                ),
-                                **(
-                                    {"disable_security": True}
-                                    if button.get("disable_security", False)
-                                    else {}
-                                ),
-                            }
-                    elif "input" in button:
-                        line += [
-                            InlineKeyboardButton(
-                                button["text"],
-                                switch_inline_query_current_chat=button["_switch_query"] + " ",  # fmt: skip
-                            )
-                        ]
-                    elif "data" in button:
-                        line += [
-                            InlineKeyboardButton(
-                                button["text"],
-                                callback_data=button["data"],
-                            )
-                        ]
-                    elif "switch_inline_query_current_chat" in button:
-                        line += [
-                            InlineKeyboardButton(
-                                button["text"],
-                                switch_inline_query_current_chat=button[
-                                    "switch_inline_query_current_chat"
-                                ],
-                            )
-                        ]
-                    elif "switch_inline_query" in button:
-                        line += [
-                            InlineKeyboardButton(
-                                button["text"],
-                                switch_inline_query_current_chat=button[
-                                    "switch_inline_query"
-                                ],
-                            )
-                        ]
-                    else:
-                        logger.warning(
-                            "Button have not been added to "
-                            "form, because it is not structured "
-                            f"properly. {button}"
-                        )
+                    btn = _BUILDERS[kind](self, button)
                 except KeyError:
                     logger.exception(
                         "Error while forming markup! Probably, you "
@@ -169,12 +120,80 @@ class Utils(InlineUnit):
                     )
                     return False
 
-            markup.row(*line)
+                if btn is not None:
+                    line.append(btn)
+
+            rows[i] = line
 
+        markup = InlineKeyboardMarkup()
+        markup.inline_keyboard = rows
         return markup
 
     generate_markup = _generate_markup
 
+    def _build_url_button(self, button: dict) -> InlineKeyboardButton | None:
+        if not isinstance(button["url"], str) or not _check_url_cached(button["url"]):
+            logger.warning(
+                "Button have not been added to form, because its url is invalid"
+            )
+            return None
+
+        return _make_button(button["text"], url=button["url"])
+
+    def _build_callback_button(
+        self,
+        button: dict,
+    ) -> InlineKeyboardButton | None:
+        if "_callback_data" not in button:
+            button["_callback_data"] = secrets.token_hex(15)
+            entry = {"handler": button["callback"]}
+
+            if button.get("always_allow", False):
+                entry["always_allow"] = button["always_allow"]
+
+            if button.get("args", False):
+                entry["args"] = button["args"]
+
+            if button.get("kwargs", False):
+                entry["kwargs"] = button["kwargs"]
+
+            if button.get("force_me", False):
+                entry["force_me"] = True
+
+            if button.get("disable_security", False):
+                entry["disable_security"] = True
+
+            self._custom_map[button["_callback_data"]] = entry
+
+        return _make_button(
+            button["text"],
+            callback_data=button["_callback_data"],
+        )
+
+    def _build_input_button(self, button: dict) -> InlineKeyboardButton | None:
+        if "_switch_query" not in button:
+            button["_switch_query"] = secrets.token_hex(5)
+
+        return _make_button(
+            button["text"],
+            switch_inline_query_current_chat=button["_switch_query"] + " ",
+        )
+
+    def _build_data_button(self, button: dict) -> InlineKeyboardButton | None:
+        return _make_button(button["text"], callback_data=button["data"])
+
+    def _build_switch_current_button(self, button: dict) -> InlineKeyboardButton | None:
+        return _make_button(
+            button["text"],
+            switch_inline_query_current_chat=button["switch_inline_query_current_chat"],
+        )
+
+    def _build_switch_button(self, button: dict) -> InlineKeyboardButton | None:
+        return _make_button(
+            button["text"],
+            switch_inline_query_current_chat=button["switch_inline_query"],
+        )
+
     async def check_inline_security(
         self,
         *,
@@ -188,58 +207,143 @@ class Utils(InlineUnit):
             message=None,
         )
 
-    def _find_caller_sec_map(self) -> Union[FunctionType, None]:
+    def _find_caller_sec_map(self) -> FunctionType | None:
         try:
-            for stack_entry in inspect.stack():
-                if hasattr(stack_entry, "function") and (
-                    stack_entry.function.endswith("cmd")
-                    or stack_entry.function.endswith("_inline_handler")
-                ):
-                    logger.debug(f"Found caller: {stack_entry.function}")
-                    return next(
-                        lambda: self._client.dispatcher.security.get_flags(
-                            getattr(
-                                cls_,
-                                stack_entry.function,
+            frame = sys._getframe(1)
+            while frame is not None:
+                name = frame.f_code.co_name
+                if name.endswith("cmd") or name.endswith("_inline_handler"):
+                    logger.debug("Found caller: %s", name)
+                    cached = self._sec_map_cache.get(frame.f_code)
+                    if cached is None:
+                        cls_ = next(
+                            (
+                                cls_
+                                for gname, cls_ in frame.f_globals.items()
+                                if gname.endswith("Mod")
+                                and isinstance(cls_, type)
+                                and issubclass(cls_, Module)
                             ),
+                            None,
                         )
-                        for name, cls_ in stack_entry.frame.f_globals.items()
-                        if name.endswith("Mod") and issubclass(cls_, Module)
-                    )
+
+                        if cls_ is None:
+                            return None
+
+                        cached = (cls_, getattr(cls_, name))
+                        self._sec_map_cache[frame.f_code] = cached
+
+                    func = cached[1]
+
+                    def perms_map() -> int:
+                        # Called on each button press, so changed rights apply in runtime
+                        return self._client.dispatcher.security.get_flags(func)
+
+                    return perms_map
+
+                frame = frame.f_back
         except Exception:
             logger.debug("Can't parse security mask in form", exc_info=True)
 
         return None
 
-    def _normalize_markup(self, reply_markup: Union[dict, list]) -> list:
+    def _invalidate_sec_map(self, cls_: type):
+        """Drop cached handlers of module class `cls_`"""
+        for code in [
+            code for code, cached in self._sec_map_cache.items() if cached[0] is cls_
+        ]:
+            del self._sec_map_cache[code]
+
+    @staticmethod
+    def _normalize_markup(reply_markup: dict | list) -> list:
         if isinstance(reply_markup, dict):
             return [[reply_markup]]
 
-        if isinstance(reply_markup, list) and any(
-            isinstance(i, dict) for i in reply_markup
-        ):
+        if not reply_markup:
+            return reply_markup
+
+        if isinstance(reply_markup, list) and isinstance(reply_markup[0], dict):
             return [reply_markup]
 
         return reply_markup
 
+    @staticmethod
+    def _button_fingerprint(button: dict) -> tuple:
+        """Return values of `button`, which affect the generated markup"""
+        kind = _get_button_kind(button)
+        # Generated ids are included, so a new button, which still needs
+        # to get them and register its callback, never matches the cached one
+        return (
+            button.get("text"),
+            kind,
+            button.get(kind),
+            button.get("_callback_data"),
+            button.get("_switch_query"),
+        )
+
+    def _markup_fingerprint(self, buttons: list) -> tuple:
+        """Return fingerprints of all `buttons`, keeping their layout"""
+        return tuple(
+            tuple(self._button_fingerprint(button) for button in row) for row in buttons
+        )
+
+    def _get_unit_markup(
+        self,
+        unit_uid: str,
+        buttons: list,
+    ) -> InlineKeyboardMarkup | None:
+        """Generate markup for `buttons`, reusing the one cached for unit if buttons are unchanged"""
+        if unit_uid not in self._units or not isinstance(buttons, list):
+            return self.generate_markup(buttons)
+
+        if not all(
+            isinstance(row, list) and all(isinstance(button, dict) for button in row)
+            for row in buttons
+        ):
+            return self.generate_markup(buttons)
+
+        cached = self._markup_cache.get(unit_uid)
+        if cached is not None and cached[0] == self._markup_fingerprint(buttons):
+            return cached[1]
+
+        markup = self.generate_markup(buttons)
+        # Generation assigns missing ids to buttons, so take fingerprint afterwards
+        self._markup_cache[unit_uid] = (self._markup_fingerprint(buttons), markup)
+        return markup
+
+    @staticmethod
+    def _validate_url_field(name: str, value, extra_types: tuple = ()) -> bool:
+        """Check that media field is either empty, valid url or instance of `extra_types`"""
+        if not value:
+            return True
+
+        if isinstance(value, str):
+            if _check_url_cached(value):
+                return True
+        elif isinstance(value, extra_types):
+            return True
+
+        logger.error("Invalid type for `%s`", name)
+        return False
+
     async def _edit_unit(
         self,
         text: str,
-        reply_markup: List[List[dict]] = None,
+        reply_markup: list[list[dict]] | None = None,
         *,
-        photo: Optional[str] = None,
-        file: Optional[str] = None,
-        video: Optional[str] = None,
-        audio: Optional[str] = None,
-        gif: Optional[str] = None,
-        mime_type: Optional[str] = None,
-        force_me: Union[bool, None] = None,
-        disable_security: Union[bool, None] = None,
-        always_allow: Union[List[int], None] = None,
+        photo: str | None = None,
+        file: str | bytes | io.BytesIO | None = None,
+        video: str | None = None,
+        audio: str | None = None,
+        gif: str | None = None,
+        mime_type: str | None = None,
+        force_me: Any = _UNSET,
+        disable_security: Any = _UNSET,
+        always_allow: Any = _UNSET,
         disable_web_page_preview: bool = True,
         query: CallbackQuery = None,
         unit_uid: str = None,
-        inline_message_id: Union[str, None] = None,
+        inline_message_id: str | None = None,
     ):
         """Do not edit or pass `self`, `query`, `unit_uid` params, they are for internal use only"""
         if isinstance(reply_markup, (list, dict)):
@@ -251,19 +355,13 @@ class Utils(InlineUnit):
             logger.error("Invalid type for `text`")
             return False
 
-        if photo and (not isinstance(photo, str) or not utils.check_url(photo)):
-            logger.error("Invalid type for `photo`")
-            return False
-
-        if gif and (not isinstance(gif, str) or not utils.check_url(gif)):
-            logger.error("Invalid type for `gif`")
-            return False
-
-        if file and (
-            not isinstance(file, str, bytes, io.BytesIO)
-            or (isinstance(file, str) and not utils.check_url(file))
+        if not (
+            self._validate_url_field("photo", photo)
+            and self._validate_url_field("gif", gif)
+            and self._validate_url_field("file", file, (bytes, io.BytesIO))
+            and self._validate_url_field("video", video)
+            and self._validate_url_field("audio", audio)
         ):
-            logger.error("Invalid type for `file`")
             return False
 
         if file and not mime_type:
@@ -273,39 +371,31 @@ class Utils(InlineUnit):
             )
             return False
 
-        if video and (not isinstance(video, str) or not utils.check_url(video)):
-            logger.error("Invalid type for `video`")
-            return False
-
-        if audio and (not isinstance(audio, str) or not utils.check_url(audio)):
-            logger.error("Invalid type for `audio`")
-            return False
-
-        media_params = [
-            photo is None,
-            gif is None,
-            file is None,
-            video is None,
-            audio is None,
-        ]
+        media_count = (
+            (photo is not None)
+            + (gif is not None)
+            + (file is not None)
+            + (video is not None)
+            + (audio is not None)
+        )
 
-        if media_params.count(False) > 1:
+        if media_count > 1:
             logger.error("You passed two or more exclusive parameters simultaneously")
             return False
 
-        if unit_uid is not None and unit_uid in self._units:
-            unit = self._units[unit_uid]
+        unit = self._units.get(unit_uid) if unit_uid is not None else None
 
+        if unit is not None:
             unit["buttons"] = reply_markup
 
-            if isinstance(force_me, bool):
+            if force_me is not _UNSET:
                 unit["force_me"] = force_me
 
-            if isinstance(disable_security, bool):
+            if disable_security is not _UNSET:
                 unit["disable_security"] = disable_security
 
-            if isinstance(always_allow, list):
-                unit["always_allow"] = always_allow
+            if always_allow is not _UNSET:
+                unit["always_allow"] = always_allow or []
         else:
             unit = {}
 
@@ -325,30 +415,76 @@ class Utils(InlineUnit):
             )
             return False
 
-        if all(media_params):
+        markup = self._get_unit_markup(
+            unit_uid,
+            reply_markup if isinstance(reply_markup, list) else unit.get("buttons", []),
+        )
+
+        if not media_count:
+            while True:
+                try:
+                    await self.bot.edit_message_text(
+                        text,
+                        inline_message_id=inline_message_id,
+                        disable_web_page_preview=disable_web_page_preview,
+                        reply_markup=markup,
+                    )
+                except MessageNotModified:
+                    if query:
+                        try:
+                            await query.answer()
+                        except InvalidQueryID:
+                            pass  # Just ignore that error, bc we need to just
+                            # remove preloader from user's button, if message
+                            # was deleted
+                except RetryAfter as e:
+                    logger.info("Sleeping %ss on aiogram FloodWait...", e.timeout)
+                    await asyncio.sleep(e.timeout)
+                    continue
+                except MessageIdInvalid:
+                    with contextlib.suppress(Exception):
+                        await query.answer(
+                            "I should have edited some message, but it is deleted :("
+                        )
+
+                return
+
+        # If passed `photo` is gif
+        ext = None
+        if photo:
+            end = len(photo)
+            for sep in ("?", "#"):
+                pos = photo.find(sep, 0, end)
+                if pos != -1:
+                    end = pos
+
+            dot = photo.rfind(".", 0, end)
+            if dot != -1:
+                ext = photo[dot:end].lower()
+
+        if photo is not None and ext in _ANIMATED_EXTS:
+            gif, photo = photo, None
+
+        media = next(
+            media_type(value, caption=text, parse_mode="HTML")
+            for media_type, value in zip(
+                _MEDIA_TYPES,
+                (file, photo, audio, video, gif),
+            )
+            if value is not None
+        )
+
+        while True:
             try:
-                await self.bot.edit_message_text(
-                    text,
+                await self.bot.edit_message_media(
                     inline_message_id=inline_message_id,
-                    disable_web_page_preview=disable_web_page_preview,
-                    reply_markup=self.generate_markup(
-                        reply_markup
-                        if isinstance(reply_markup, list)
-                        else unit.get("buttons", [])
-                    ),
+                    media=media,
+                    reply_markup=markup,
                 )
-            except MessageNotModified:
-                if query:
-                    try:
-                        await query.answer()
-                    except InvalidQueryID:
-                        pass  # Just ignore that error, bc we need to just
-                        # remove preloader from user's button, if message
-                        # was deleted
             except RetryAfter as e:
-                logger.info(f"Sleeping {e.timeout}s on aiogram FloodWait...")
+                logger.info("Sleeping %ss on aiogram FloodWait...", e.timeout)
                 await asyncio.sleep(e.timeout)
-                return await self._edit_unit(**utils.get_kwargs())
+                continue
             except MessageIdInvalid:
                 with contextlib.suppress(Exception):
                     await query.answer(
@@ -357,59 +493,18 @@ class Utils(InlineUnit):
 
             return
 
-        # If passed `photo` is gif
-        try:
-            path = urlparse(media).path
-            ext = os.path.splitext(path)[1]
-        except Exception:
-            ext = None
-
-        if photo is not None and ext in {".gif", ".mp4"}:
-            gif = deepcopy(photo)
-            photo = None
-
-        if file is not None:
-            media = InputMediaDocument(file, caption=text, parse_mode="HTML")
-        elif photo is not None:
-            media = InputMediaPhoto(photo, caption=text, parse_mode="HTML")
-        elif audio is not None:
-            media = InputMediaAudio(audio, caption=text, parse_mode="HTML")
-        elif video is not None:
-            media = InputMediaVideo(video, caption=text, parse_mode="HTML")
-        elif gif is not None:
-            media = InputMediaAnimation(gif, caption=text, parse_mode="HTML")
-
-        try:
-            await self.bot.edit_message_media(
-                inline_message_id=inline_message_id,
-                media=media,
-                reply_markup=self.generate_markup(
-                    reply_markup
-                    if isinstance(reply_markup, list)
-                    else unit.get("buttons", [])
-                ),
-            )
-        except RetryAfter as e:
-            logger.info(f"Sleeping {e.timeout}s on aiogram FloodWait...")
-            await asyncio.sleep(e.timeout)
-            return await self._edit_unit(**utils.get_kwargs())
-        except MessageIdInvalid:
-            with contextlib.suppress(Exception):
-                await query.answer(
-                    "I should have edited some message, but it is deleted :("
-                )
-
     async def _delete_unit_message(
         self,
         call: CallbackQuery = None,
         unit_uid: str = None,
     ) -> bool:
         """Params `self`, `form`, `unit_uid` are for internal use only, do not try to pass them"""
+        unit = self._units.get(unit_uid)
+        if unit is None:
+            return False
+
         try:
-            await self._client.delete_messages(
-                self._units[unit_uid]["chat"],
-                [self._units[unit_uid]["message_id"]],
-            )
+            await self._client.delete_messages(unit["chat"], [unit["message_id"]])
 
             await self._unload_unit(None, unit_uid)
         except Exception:
@@ -423,17 +518,39 @@ class Utils(InlineUnit):
         unit_uid: str = None,
     ) -> bool:
         """Params `self`, `unit_uid` are for internal use only, do not try to pass them"""
+        self._markup_cache.pop(unit_uid, None)
+        unit = self._units.pop(unit_uid, None)
+        if unit is None:
+            return False
+
         try:
-            if "on_unload" in self._units[unit_uid] and callable(
-                self._units[unit_uid]["on_unload"]
-            ):
-                self._units[unit_uid]["on_unload"]()
-
-            if unit_uid in self._units:
-                del self._units[unit_uid]
-            else:
-                return False
+            on_unload = unit.get("on_unload")
+            if callable(on_unload):
+                # Regular callbacks stay on the loop, as they may use it
+                # (e.g. `db.set` schedules saving via `asyncio.ensure_future`)
+                if asyncio.iscoroutinefunction(on_unload):
+                    await on_unload()
+                else:
+                    on_unload()
         except Exception:
             return False
 
         return True
+
+
+# Order matters: the first kind found in button is used
+_BUILDERS = {
+    "url": Utils._build_url_button,
+    "callback": Utils._build_callback_button,
+    "input": Utils._build_input_button,
+    "data": Utils._build_data_button,
+    "switch_inline_query_current_chat": Utils._build_switch_current_button,
+    "switch_inline_query": Utils._build_switch_button,
+}
+
+_BTN_KEYS = tuple(_BUILDERS)
+
+
+def _get_button_kind(button: dict) -> str | None:
+    """Return the first key of `button`, which defines its kind"""
+    return next((kind for kind in _BTN_KEYS if kind in button), None)
@@ -538,6 +538,9 @@ class Modules:
                 logger.debug(f"Removing module for update {module}")
                 asyncio.ensure_future(module.on_unload())
 
+                if hasattr(self, "inline"):
+                    self.inline._invalidate_sec_map(module.__class__)
+
                 self.modules.remove(module)
                 for method in dir(module):
                     if isinstance(getattr(module, method), InfiniteLoop):
@@ -796,6 +799,9 @@ class Modules:
                 logger.debug(f"Removing module for unload {module}")
                 self.modules.remove(module)
 
+                if hasattr(self, "inline"):
+                    self.inline._invalidate_sec_map(module.__class__)
+
                 asyncio.ensure_future(module.on_unload())
 
                 for method in dir(module):